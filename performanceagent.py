@@ -1,40 +1,90 @@
 import psutil
+import os
 import time
-from datetime import datetime
-import csv
+from collections import defaultdict
+import atexit
 import configparser
-from prometheus_client import start_http_server, Gauge
-from socket import gethostname
-from graphiteudp import GraphiteUDPClient
+import pickle
+import queue
+import struct
+import threading
+from prometheus_client import start_http_server, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from socket import gethostname, create_connection
 
-# Load configuration
-config = configparser.ConfigParser()
+try:
+    import ahocorasick  # pyahocorasick: C-level multi-pattern matching
+except ImportError:
+    ahocorasick = None
+
+# Load configuration. Inline comments are in use in config.ini (e.g. the
+# graphite port annotation), and ConfigParser keeps them as part of the
+# value unless told otherwise.
+config = configparser.ConfigParser(inline_comment_prefixes=('#',))
 config.read('config.ini')
 
 # Observability backends
-BACKENDS = config['observability']['backends'].split(',')
+BACKENDS = frozenset(config['observability']['backends'].split(','))
+
+# Resolved once: gethostname() is a syscall and the value never changes
+# for the life of the agent
+HOSTNAME = gethostname()
 
-# Prometheus setup
+# Prometheus setup. Metrics are exposed through a pull-model collector
+# (registered in main) whose collect() runs once per scrape, so nothing
+# is gathered for Prometheus between scrapes.
 if 'prometheus' in BACKENDS:
     PROMETHEUS_PORT = int(config['prometheus']['port'])
-    PROCESS_CPU_USAGE = Gauge('process_cpu_usage', 'Process CPU Usage (%)', ['role'])
-    PROCESS_MEMORY_USAGE = Gauge('process_memory_usage', 'Process Memory Usage (MB)', ['role'])
-    PROCESS_THREADS = Gauge('process_num_threads', 'Process Number of Threads', ['role'])
-    PROCESS_DISK_READ_BYTES = Gauge('process_disk_read_bytes', 'Process Disk Read Bytes', ['role'])
-    PROCESS_DISK_WRITE_BYTES = Gauge('process_disk_write_bytes', 'Process Disk Write Bytes', ['role'])
-    PROCESS_NETWORK_SENT_BYTES = Gauge('process_network_sent_bytes', 'Process Network Sent Bytes', ['role'])
-    PROCESS_NETWORK_RECV_BYTES = Gauge('process_network_recv_bytes', 'Process Network Received Bytes', ['role'])
-
-# Graphite setup
+
+# Graphite setup. All metrics for a tick go out as one batch over the
+# pickle protocol (port 2004): a length-prefixed pickle of
+# (path, (timestamp, value)) tuples, one sendall per tick instead of a
+# datagram per metric.
 if 'graphite' in BACKENDS:
     GRAPHITE_HOST = config['graphite']['host']
     GRAPHITE_PORT = int(config['graphite']['port'])
-    graphite_client = GraphiteUDPClient(GRAPHITE_HOST, GRAPHITE_PORT)
-    graphite_client.connect()
+    GRAPHITE_ADDR = (GRAPHITE_HOST, GRAPHITE_PORT)
+    GRAPHITE_PREFIX = HOSTNAME + '.'
+    _graphite_socket = None  # TCP connection, established lazily
 
-# File logging setup
+# File logging setup. The log file is opened once for the process
+# lifetime; rows are serialized with a prebuilt format string (the csv
+# module's per-cell quoting machinery is wasted on all-numeric rows) and
+# written with one os.write per flush.
 if 'file' in BACKENDS:
     LOG_FILE = config['file']['log_file']
+    CSV_HEADER = ('timestamp,role,avg_cpu_usage,total_memory_usage,total_num_threads,'
+                  'total_disk_read_bytes,total_disk_write_bytes,total_network_sent_bytes,'
+                  'total_network_recv_bytes,open_files\n')
+    ROW_FMT = ('{timestamp},{role},{avg_cpu_usage:.2f},{total_memory_usage:.2f},'
+               '{total_num_threads},{total_disk_read_bytes},{total_disk_write_bytes},'
+               '{total_network_sent_bytes},{total_network_recv_bytes},{open_files}\n')
+    # Rows accumulate in _csv_buffer and are flushed to the kernel every
+    # CSV_FLUSH_EVERY ticks, amortizing the write syscall across many
+    # rows instead of issuing one tiny write per tick.
+    CSV_FLUSH_EVERY = 8
+    _csv_ticks_since_flush = 0
+    _csv_buffer = []
+    _csv_fd = os.open(LOG_FILE, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    if os.fstat(_csv_fd).st_size == 0:  # Write the header only if the file is new
+        os.write(_csv_fd, CSV_HEADER.encode())
+
+    def _flush_csv_buffer():
+        global _csv_ticks_since_flush
+        if _csv_buffer:
+            os.write(_csv_fd, ''.join(_csv_buffer).encode())
+            _csv_buffer.clear()
+        _csv_ticks_since_flush = 0
+
+    atexit.register(_flush_csv_buffer)
+
+# Application collection options. Even when enabled, open-files
+# enumeration only refreshes every OPEN_FILES_EVERY ticks (once a minute
+# at the 5s cadence) since it costs a readlink per open fd.
+COLLECT_OPEN_FILES = config.getboolean('application', 'collect_open_files', fallback=False)
+OPEN_FILES_EVERY = 12
+_open_files_cache = {}
+_collect_tick = 0
 
 # Application configuration
 APP_CONFIG = {
@@ -47,10 +97,183 @@ APP_CONFIG = {
     }
 }
 
+# Flatten APP_CONFIG once at import into (needle, role_label) tables so the
+# hot loop does a single linear scan instead of a nested dict walk per process.
+NAME_TABLE = [(cfg["name"], f"{app}_{role}")
+              for app, roles in APP_CONFIG.items()
+              for role, cfg in roles.items() if "name" in cfg]
+CMDLINE_TABLE = [(cfg["cmdline"], f"{app}_{role}")
+                 for app, roles in APP_CONFIG.items()
+                 for role, cfg in roles.items() if "cmdline" in cfg]
+
+def _build_automaton(table):
+    """Compile a matcher table into an Aho-Corasick automaton, or None if unavailable."""
+    if ahocorasick is None or not table:
+        return None
+    automaton = ahocorasick.Automaton()
+    for needle, label in table:
+        automaton.add_word(needle, label)
+    automaton.make_automaton()
+    return automaton
+
+_NAME_AUTOMATON = _build_automaton(NAME_TABLE)
+_CMDLINE_AUTOMATON = _build_automaton(CMDLINE_TABLE)
+
+def _match_role(name, cmdline):
+    """Classify a process into a role label, or None if it matches nothing.
+
+    With pyahocorasick installed all needles are matched in one C-level pass
+    over the string; otherwise fall back to a linear scan of the tables.
+    """
+    if ahocorasick is not None:
+        if _NAME_AUTOMATON is not None:
+            role = next((label for _, label in _NAME_AUTOMATON.iter(name)), None)
+            if role:
+                return role
+        if _CMDLINE_AUTOMATON is not None:
+            return next((label for _, label in _CMDLINE_AUTOMATON.iter(cmdline)), None)
+        return None
+    return next((label for needle, label in NAME_TABLE if needle in name), None) \
+        or next((label for needle, label in CMDLINE_TABLE if needle in cmdline), None)
+
+_CLK_TCK = os.sysconf('SC_CLK_TCK')
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+_NUM_CPUS = os.cpu_count() or 1
+_BYTES_TO_MB = 1.0 / (1024 * 1024)  # Multiply instead of dividing in the hot loop
+
+# Per-PID CPU bookkeeping across ticks: pid -> (starttime, total_jiffies,
+# system_jiffies). The starttime (jiffies since boot, from
+# /proc/<pid>/stat) guards against PID reuse between ticks.
+_cpu_cache = {}
+
+def _read_proc_file(path):
+    """Read a small /proc file, returning None if the process is gone or denied."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def read_proc_stat(pid):
+    """Read /proc/<pid>/stat in one pass.
+
+    Returns (total_jiffies, num_threads, rss_bytes, starttime) or None if
+    the process is gone. One open/read/close replaces the separate psutil
+    calls for cpu times, thread count and rss.
+    """
+    data = _read_proc_file(f"/proc/{pid}/stat")
+    if data is None:
+        return None
+    # comm (field 2) may contain spaces; everything after the closing paren
+    # is whitespace-separated, so fields[0] is field 3 of the stat line.
+    fields = data[data.rindex(b')') + 2:].split()
+    total_jiffies = int(fields[11]) + int(fields[12])  # utime + stime
+    num_threads = int(fields[17])
+    starttime = int(fields[19])
+    rss_bytes = int(fields[21]) * _PAGE_SIZE
+    return total_jiffies, num_threads, rss_bytes, starttime
+
+def read_proc_io(pid):
+    """Read disk I/O counters from /proc/<pid>/io.
+
+    Returns (read_bytes, write_bytes); (0, 0) when the file is unreadable
+    (kernel lacks CONFIG_TASK_IO_ACCOUNTING or permission is denied).
+    """
+    data = _read_proc_file(f"/proc/{pid}/io")
+    if data is None:
+        return 0, 0
+    read_bytes = write_bytes = 0
+    for line in data.splitlines():
+        if line.startswith(b'read_bytes:'):
+            read_bytes = int(line[11:])
+        elif line.startswith(b'write_bytes:'):
+            write_bytes = int(line[12:])
+    return read_bytes, write_bytes
+
+def read_system_jiffies():
+    """Total jiffies across all CPUs from the first line of /proc/stat."""
+    data = _read_proc_file("/proc/stat")
+    return sum(int(field) for field in data[4:data.index(b'\n')].split())
+
+def _cpu_percent(pid, starttime, total_jiffies, system_jiffies):
+    """CPU usage since the previous tick, derived from jiffy deltas.
+
+    The denominator is the /proc/stat jiffy delta read in the same tick,
+    so process and system clocks cannot skew apart. Returns 0.0 on first
+    sight of a (pid, starttime) pair, mirroring psutil's primed
+    cpu_percent behaviour.
+    """
+    cached = _cpu_cache.get(pid)
+    _cpu_cache[pid] = (starttime, total_jiffies, system_jiffies)
+    if cached is None or cached[0] != starttime:
+        return 0.0
+    elapsed = (system_jiffies - cached[2]) / _NUM_CPUS
+    if elapsed <= 0:
+        return 0.0
+    return (total_jiffies - cached[1]) / elapsed * 100
+
+def list_open_files(pid):
+    """Resolve open file paths from /proc/<pid>/fd, skipping sockets and pipes."""
+    paths = []
+    try:
+        for fd in os.listdir(f"/proc/{pid}/fd"):
+            try:
+                path = os.readlink(f"/proc/{pid}/fd/{fd}")
+            except OSError:
+                continue
+            if path.startswith('/'):
+                paths.append(path)
+    except OSError:
+        pass
+    return paths
+
+# Role-matched processes under watch: pid -> (role, starttime). Matching
+# keys (name/cmdline) are fixed at exec() time, so the full walk of every
+# PID on the host only happens on the slow cadence; fast ticks poll just
+# the watchlist. starttime detects PID reuse between scans.
+FULL_SCAN_EVERY = 12
+_watchlist = {}
+
+def _rescan_watchlist():
+    """Walk every PID and rebuild the watchlist of role-matched processes."""
+    matched = {}
+    for pid in psutil.pids():
+        # Read name/cmdline straight from /proc: process_iter builds a
+        # fresh Process and does a create_time roundtrip per PID, which
+        # is wasted work for the vast majority of non-matching processes.
+        comm = _read_proc_file(f"/proc/{pid}/comm")
+        if comm is None:
+            continue  # Process exited between pids() and here
+        name = comm.decode(errors='replace').rstrip('\n')
+        raw_cmdline = _read_proc_file(f"/proc/{pid}/cmdline") or b""
+        cmdline = raw_cmdline.replace(b'\x00', b' ').decode(errors='replace').strip()
+
+        role = _match_role(name, cmdline)
+        if role is None:
+            continue
+        stat = read_proc_stat(pid)
+        if stat is None:
+            continue
+        matched[pid] = (role, stat[3])
+    return matched
+
 def collect_application_metrics():
     """Collect application-level metrics."""
+    global _collect_tick, _watchlist
+    _collect_tick += 1
+
+    # Full /proc scan on the slow cadence only; prune per-PID caches of
+    # anything that fell off the watchlist
+    if (_collect_tick - 1) % FULL_SCAN_EVERY == 0:
+        _watchlist = _rescan_watchlist()
+        for pid in list(_cpu_cache):
+            if pid not in _watchlist:
+                del _cpu_cache[pid]
+                _open_files_cache.pop(pid, None)
+
     metrics_by_role = defaultdict(lambda: {
-        "cpu_usage": [],
+        "cpu_sum": 0.0,
+        "cpu_count": 0,
         "memory_usage": 0,
         "num_threads": 0,
         "disk_read_bytes": 0,
@@ -60,155 +283,210 @@ def collect_application_metrics():
         "open_files": []
     })
 
-    for process in psutil.process_iter(['pid', 'name', 'cmdline']):
-        try:
-            pid = process.info['pid']
-            name = process.info['name']
-            cmdline = " ".join(process.info['cmdline'])
-
-            # Determine the role of the process based on the configuration
-            role = None
-            for app_name, app_roles in APP_CONFIG.items():
-                for role_name, role_config in app_roles.items():
-                    if ("name" in role_config and role_config["name"] in name) or \
-                       ("cmdline" in role_config and role_config["cmdline"] in cmdline):
-                        role = f"{app_name}_{role_name}"
-                        break
-                if role:
-                    break
-
-            if not role:
-                continue  # Skip processes that don't match any role
-
-            # Collect process-specific metrics
-            cpu_usage = process.cpu_percent(interval=0.1)
-            memory_info = process.memory_info().rss / (1024 * 1024)  # Convert to MB
-            num_threads = process.num_threads()
-
-            # Disk I/O metrics
-            io_counters = process.io_counters()
-            disk_read_bytes = io_counters.read_bytes
-            disk_write_bytes = io_counters.write_bytes
-
-            # Network I/O metrics
-            net_io_counters = psutil.net_io_counters()
-            network_sent_bytes = net_io_counters.bytes_sent
-            network_recv_bytes = net_io_counters.bytes_recv
-
-            # File operations
-            open_files = [f.path for f in process.open_files()]
-
-            # Aggregate metrics by role
-            metrics_by_role[role]["cpu_usage"].append(cpu_usage)
-            metrics_by_role[role]["memory_usage"] += memory_info
-            metrics_by_role[role]["num_threads"] += num_threads
-            metrics_by_role[role]["disk_read_bytes"] += disk_read_bytes
-            metrics_by_role[role]["disk_write_bytes"] += disk_write_bytes
-            metrics_by_role[role]["network_sent_bytes"] += network_sent_bytes
-            metrics_by_role[role]["network_recv_bytes"] += network_recv_bytes
-            metrics_by_role[role]["open_files"].extend(open_files)
-
-        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+    # Host-wide counters: /proc/net/dev cannot be attributed per process,
+    # so read it once per tick rather than once per matched process.
+    net_io_counters = psutil.net_io_counters()
+    network_sent_bytes = net_io_counters.bytes_sent
+    network_recv_bytes = net_io_counters.bytes_recv
+
+    system_jiffies = read_system_jiffies()
+    for pid, (role, starttime) in list(_watchlist.items()):
+        # Collect process-specific metrics: one read of /proc/<pid>/stat
+        # and one of /proc/<pid>/io instead of a psutil call per field.
+        stat = read_proc_stat(pid)
+        if stat is None or stat[3] != starttime:
+            # Process exited (or the PID was reused); drop it until the
+            # next full scan picks up its successor
+            del _watchlist[pid]
+            _cpu_cache.pop(pid, None)
+            _open_files_cache.pop(pid, None)
             continue
+        total_jiffies, num_threads, rss_bytes, _ = stat
+        cpu_usage = _cpu_percent(pid, starttime, total_jiffies, system_jiffies)
+        memory_info = rss_bytes * _BYTES_TO_MB  # Convert to MB
+
+        # Disk I/O metrics
+        disk_read_bytes, disk_write_bytes = read_proc_io(pid)
+
+        # File operations (O(open fds) syscalls, so off by default and
+        # refreshed on the slow cadence even when enabled)
+        if COLLECT_OPEN_FILES:
+            if pid not in _open_files_cache or _collect_tick % OPEN_FILES_EVERY == 0:
+                _open_files_cache[pid] = list_open_files(pid)
+            open_files = _open_files_cache[pid]
+        else:
+            open_files = []
+
+        # Aggregate metrics by role
+        metrics_by_role[role]["cpu_sum"] += cpu_usage
+        metrics_by_role[role]["cpu_count"] += 1
+        metrics_by_role[role]["memory_usage"] += memory_info
+        metrics_by_role[role]["num_threads"] += num_threads
+        metrics_by_role[role]["disk_read_bytes"] += disk_read_bytes
+        metrics_by_role[role]["disk_write_bytes"] += disk_write_bytes
+        # Host-wide totals: assign, don't accumulate, or every matched
+        # process would add the same counters again
+        metrics_by_role[role]["network_sent_bytes"] = network_sent_bytes
+        metrics_by_role[role]["network_recv_bytes"] = network_recv_bytes
+        metrics_by_role[role]["open_files"].extend(open_files)
 
     return metrics_by_role
 
-def publish_to_prometheus(metrics_by_role):
-    """Publish metrics to Prometheus."""
-    for role, metrics in metrics_by_role.items():
-        avg_cpu_usage = sum(metrics["cpu_usage"]) / len(metrics["cpu_usage"]) if metrics["cpu_usage"] else 0
-        total_memory_usage = metrics["memory_usage"]
-        total_num_threads = metrics["num_threads"]
-        total_disk_read_bytes = metrics["disk_read_bytes"]
-        total_disk_write_bytes = metrics["disk_write_bytes"]
-        total_network_sent_bytes = metrics["network_sent_bytes"]
-        total_network_recv_bytes = metrics["network_recv_bytes"]
-
-        PROCESS_CPU_USAGE.labels(role=role).set(avg_cpu_usage)
-        PROCESS_MEMORY_USAGE.labels(role=role).set(total_memory_usage)
-        PROCESS_THREADS.labels(role=role).set(total_num_threads)
-        PROCESS_DISK_READ_BYTES.labels(role=role).set(total_disk_read_bytes)
-        PROCESS_DISK_WRITE_BYTES.labels(role=role).set(total_disk_write_bytes)
-        PROCESS_NETWORK_SENT_BYTES.labels(role=role).set(total_network_sent_bytes)
-        PROCESS_NETWORK_RECV_BYTES.labels(role=role).set(total_network_recv_bytes)
+# Collection mutates the shared per-PID caches, and with the pull-model
+# Prometheus collector both the producer loop and the scrape handler can
+# call it; callers take this lock around collect_application_metrics().
+_collect_lock = threading.Lock()
+
+class ApplicationMetricsCollector:
+    """Pull-model Prometheus collector.
+
+    collect() runs once per scrape, so the agent does no Prometheus work
+    between scrapes; with eager gauges every 5s tick paid the full
+    collection and registry update even at a 30s scrape interval.
+    """
+
+    def collect(self):
+        with _collect_lock:
+            metrics_by_role = collect_application_metrics()
+
+        families = {
+            name: GaugeMetricFamily(f"process_{name}", doc, labels=['role'])
+            for name, doc in [
+                ('cpu_usage', 'Process CPU Usage (%)'),
+                ('memory_usage', 'Process Memory Usage (MB)'),
+                ('num_threads', 'Process Number of Threads'),
+                ('disk_read_bytes', 'Process Disk Read Bytes'),
+                ('disk_write_bytes', 'Process Disk Write Bytes'),
+                ('network_sent_bytes', 'Process Network Sent Bytes'),
+                ('network_recv_bytes', 'Process Network Received Bytes'),
+            ]
+        }
+        for role, metrics in metrics_by_role.items():
+            avg_cpu_usage = metrics["cpu_sum"] / metrics["cpu_count"] if metrics["cpu_count"] else 0.0
+            families['cpu_usage'].add_metric([role], avg_cpu_usage)
+            families['memory_usage'].add_metric([role], metrics["memory_usage"])
+            families['num_threads'].add_metric([role], metrics["num_threads"])
+            families['disk_read_bytes'].add_metric([role], metrics["disk_read_bytes"])
+            families['disk_write_bytes'].add_metric([role], metrics["disk_write_bytes"])
+            families['network_sent_bytes'].add_metric([role], metrics["network_sent_bytes"])
+            families['network_recv_bytes'].add_metric([role], metrics["network_recv_bytes"])
+        yield from families.values()
+
+def _send_graphite_batch(batch):
+    """Send a metric batch over Graphite's pickle protocol in one sendall."""
+    global _graphite_socket
+    payload = pickle.dumps(batch, protocol=2)
+    message = struct.pack("!L", len(payload)) + payload
+    try:
+        if _graphite_socket is None:
+            _graphite_socket = create_connection(GRAPHITE_ADDR, timeout=5)
+        _graphite_socket.sendall(message)
+    except OSError:
+        # Drop this batch; the next one will reconnect
+        if _graphite_socket is not None:
+            _graphite_socket.close()
+        _graphite_socket = None
 
 def publish_to_graphite(metrics_by_role):
     """Publish metrics to Graphite."""
-    hostname = gethostname()
+    timestamp = int(time.time())
+    batch = []
     for role, metrics in metrics_by_role.items():
-        avg_cpu_usage = sum(metrics["cpu_usage"]) / len(metrics["cpu_usage"]) if metrics["cpu_usage"] else 0
-        total_memory_usage = metrics["memory_usage"]
-        total_num_threads = metrics["num_threads"]
-        total_disk_read_bytes = metrics["disk_read_bytes"]
-        total_disk_write_bytes = metrics["disk_write_bytes"]
-        total_network_sent_bytes = metrics["network_sent_bytes"]
-        total_network_recv_bytes = metrics["network_recv_bytes"]
-
-        graphite_client.send(f"{hostname}.{role}.cpu_usage", avg_cpu_usage)
-        graphite_client.send(f"{hostname}.{role}.memory_usage", total_memory_usage)
-        graphite_client.send(f"{hostname}.{role}.num_threads", total_num_threads)
-        graphite_client.send(f"{hostname}.{role}.disk_read_bytes", total_disk_read_bytes)
-        graphite_client.send(f"{hostname}.{role}.disk_write_bytes", total_disk_write_bytes)
-        graphite_client.send(f"{hostname}.{role}.network_sent_bytes", total_network_sent_bytes)
-        graphite_client.send(f"{hostname}.{role}.network_recv_bytes", total_network_recv_bytes)
+        avg_cpu_usage = metrics["cpu_sum"] / metrics["cpu_count"] if metrics["cpu_count"] else 0.0
+        prefix = GRAPHITE_PREFIX + role + '.'
+
+        batch.append((prefix + 'cpu_usage', (timestamp, avg_cpu_usage)))
+        batch.append((prefix + 'memory_usage', (timestamp, metrics['memory_usage'])))
+        batch.append((prefix + 'num_threads', (timestamp, metrics['num_threads'])))
+        batch.append((prefix + 'disk_read_bytes', (timestamp, metrics['disk_read_bytes'])))
+        batch.append((prefix + 'disk_write_bytes', (timestamp, metrics['disk_write_bytes'])))
+        batch.append((prefix + 'network_sent_bytes', (timestamp, metrics['network_sent_bytes'])))
+        batch.append((prefix + 'network_recv_bytes', (timestamp, metrics['network_recv_bytes'])))
+
+    if batch:
+        _send_graphite_batch(batch)
 
 def publish_to_file(metrics_by_role):
     """Publish metrics to a CSV file."""
-    aggregated_metrics = []
+    # One timestamp per tick: every row in this cycle shares it, and
+    # time.strftime skips the datetime object construction entirely
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
     for role, metrics in metrics_by_role.items():
-        avg_cpu_usage = sum(metrics["cpu_usage"]) / len(metrics["cpu_usage"]) if metrics["cpu_usage"] else 0
-        total_memory_usage = metrics["memory_usage"]
-        total_num_threads = metrics["num_threads"]
-        total_disk_read_bytes = metrics["disk_read_bytes"]
-        total_disk_write_bytes = metrics["disk_write_bytes"]
-        total_network_sent_bytes = metrics["network_sent_bytes"]
-        total_network_recv_bytes = metrics["network_recv_bytes"]
+        avg_cpu_usage = metrics["cpu_sum"] / metrics["cpu_count"] if metrics["cpu_count"] else 0.0
         open_files = ", ".join(metrics["open_files"])
+        if open_files:  # The only field that can need CSV quoting
+            open_files = '"' + open_files.replace('"', '""') + '"'
+
+        _csv_buffer.append(ROW_FMT.format(
+            timestamp=timestamp,
+            role=role,
+            avg_cpu_usage=avg_cpu_usage,
+            total_memory_usage=metrics["memory_usage"],
+            total_num_threads=metrics["num_threads"],
+            total_disk_read_bytes=metrics["disk_read_bytes"],
+            total_disk_write_bytes=metrics["disk_write_bytes"],
+            total_network_sent_bytes=metrics["network_sent_bytes"],
+            total_network_recv_bytes=metrics["network_recv_bytes"],
+            open_files=open_files
+        ))
+
+    # Flush on a slow cadence so the kernel sees one large write instead
+    # of one per tick
+    global _csv_ticks_since_flush
+    _csv_ticks_since_flush += 1
+    if _csv_ticks_since_flush >= CSV_FLUSH_EVERY:
+        _flush_csv_buffer()
 
-        aggregated_metrics.append({
-            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            'role': role,
-            'avg_cpu_usage': avg_cpu_usage,
-            'total_memory_usage': total_memory_usage,
-            'total_num_threads': total_num_threads,
-            'total_disk_read_bytes': total_disk_read_bytes,
-            'total_disk_write_bytes': total_disk_write_bytes,
-            'total_network_sent_bytes': total_network_sent_bytes,
-            'total_network_recv_bytes': total_network_recv_bytes,
-            'open_files': open_files
-        })
-
-    # Write metrics to the CSV file
-    with open(LOG_FILE, 'a', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=[
-            'timestamp', 'role', 'avg_cpu_usage', 'total_memory_usage', 'total_num_threads',
-            'total_disk_read_bytes', 'total_disk_write_bytes', 'total_network_sent_bytes',
-            'total_network_recv_bytes', 'open_files'
-        ])
-        if f.tell() == 0:  # Write the header only if the file is new
-            writer.writeheader()
-        writer.writerows(aggregated_metrics)
+COLLECTION_INTERVAL = 5
+
+# Backends that need the agent to push on a timer; Prometheus pulls
+PUSH_BACKENDS = frozenset({'graphite', 'file'})
+
+def _publisher(publish_queue):
+    """Drain collected metrics and fan out to the selected push backends."""
+    while True:
+        metrics_by_role = publish_queue.get()
+        # An uncaught error here would kill the thread silently and the
+        # main loop would drop every later sample on the full queue, so
+        # log the failure and keep draining
+        try:
+            if 'graphite' in BACKENDS:
+                publish_to_graphite(metrics_by_role)
+            if 'file' in BACKENDS:
+                publish_to_file(metrics_by_role)
+        except Exception as exc:
+            print(f"Publish failed, dropping this sample: {exc}")
 
 def main():
-    # Start Prometheus HTTP server if selected
+    # Start Prometheus HTTP server if selected; metrics are collected on
+    # demand by the registered collector when a scrape arrives
     if 'prometheus' in BACKENDS:
+        REGISTRY.register(ApplicationMetricsCollector())
         start_http_server(PROMETHEUS_PORT)
         print(f"Metrics exposed on Prometheus port {PROMETHEUS_PORT}.")
 
+    # Only push backends need the periodic producer loop
+    if not BACKENDS & PUSH_BACKENDS:
+        threading.Event().wait()  # Scrape handler does all remaining work
+
+    # Publishing runs on its own thread so backend latency (CSV flush,
+    # Graphite sends) cannot push the next collection off the 5s grid.
+    publish_queue = queue.Queue(maxsize=4)
+    threading.Thread(target=_publisher, args=(publish_queue,), daemon=True).start()
+
     while True:
-        # Collect metrics
-        metrics_by_role = collect_application_metrics()
-
-        # Publish metrics to selected backends
-        if 'prometheus' in BACKENDS:
-            publish_to_prometheus(metrics_by_role)
-        if 'graphite' in BACKENDS:
-            publish_to_graphite(metrics_by_role)
-        if 'file' in BACKENDS:
-            publish_to_file(metrics_by_role)
-
-        # Sleep for the collection interval
-        time.sleep(5)
+        start = time.monotonic()
+
+        # Collect metrics and hand them to the publisher thread
+        with _collect_lock:
+            metrics_by_role = collect_application_metrics()
+        try:
+            publish_queue.put_nowait(metrics_by_role)
+        except queue.Full:
+            pass  # Publisher is behind; drop this sample to keep cadence
+
+        # Sleep for the rest of the collection interval
+        time.sleep(max(0, COLLECTION_INTERVAL - (time.monotonic() - start)))
 
 if __name__ == "__main__":
     main()